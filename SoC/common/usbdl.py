@@ -1,7 +1,10 @@
 #!/usr/bin/env python3
 
 import argparse
+import array
 import binascii
+import os
+import select
 import serial
 import struct
 import sys
@@ -18,6 +21,36 @@ def print_ranges(ranges):
     for base, count in sorted(ranges.items()):
         print("0x{:08X}: 0x{:08x}".format(base, count))
 
+# Typecode of a 32-bit unsigned int array. 'I' is 32 bits on most
+# platforms, but C only guarantees 16.
+for U32_TYPECODE in ('I', 'L'):
+    if array.array(U32_TYPECODE).itemsize == 4:
+        break
+else:
+    raise ImportError("No 32-bit unsigned array typecode on this platform.")
+
+
+# BROM DL mode command bytes.
+CMD_C8 = b'\xC8'  # Don't know the meaning of this yet.
+CMD_READ32 = b'\xD1'
+CMD_WRITE32 = b'\xD4'
+CMD_JUMP_DA = b'\xD5'
+CMD_JUMP_BL = b'\xD6'
+CMD_SEND_DA = b'\xD7'
+CMD_GET_TARGET_CONFIG = b'\xD8'
+CMD_UART1_LOG_EN = b'\xDB'
+CMD_UART1_SET_BAUD = b'\xDC'  # Not sure what the real name of this command is.
+CMD_GET_BROM_LOG = b'\xDD'  # Not sure what the real name of this command is.
+CMD_JUMP_DA_64 = b'\xDE'  # Not sure what the real name of this command is.
+CMD_GET_BROM_LOG_NEW = b'\xDF'  # Not sure what the real name of this command is.
+SCMD_SEND_CERT = b'\xE0'
+SCMD_GET_ME_ID = b'\xE1'
+SCMD_SEND_AUTH = b'\xE2'
+SCMD_GET_SOC_ID = b'\xE7'  # The "SCMD" part of the name is a guess.
+CMD_GET_HW_SW_VER = b'\xFC'
+CMD_GET_HW_CODE = b'\xFD'
+CMD_GET_BL_VER = b'\xFE'  # Not available in BROM mode, use to detect BROM DL mode.
+
 
 class ChecksumError(Exception):
     pass
@@ -38,27 +71,25 @@ class SocNotRecognizedError(Exception):
     pass
 
 class UsbDl:
-    commands = {
-        'CMD_C8': 0xC8, # Don't know the meaning of this yet.
-        'CMD_READ32': 0xD1,
-        'CMD_WRITE32': 0xD4,
-        'CMD_JUMP_DA': 0xD5,
-        'CMD_JUMP_BL': 0xD6,
-        'CMD_SEND_DA': 0xD7,
-        'CMD_GET_TARGET_CONFIG': 0xD8,
-        'CMD_UART1_LOG_EN': 0xDB,
-        'CMD_UART1_SET_BAUD': 0xDC, # Not sure what the real name of this command is.
-        'CMD_GET_BROM_LOG': 0xDD, # Not sure what the real name of this command is.
-        'CMD_JUMP_DA_64': 0xDE, # Not sure what the real name of this command is.
-        'CMD_GET_BROM_LOG_NEW': 0xDF,  # Not sure what the real name of this command is.
-        'SCMD_SEND_CERT': 0xE0,
-        'SCMD_GET_ME_ID': 0xE1,
-        'SCMD_SEND_AUTH': 0xE2,
-        'SCMD_GET_SOC_ID': 0xE7,  # The "SCMD" part of the name is a guess.
-        'CMD_GET_HW_SW_VER': 0xFC,
-        'CMD_GET_HW_CODE': 0xFD,
-        'CMD_GET_BL_VER': 0xFE,  # Not available in BROM mode, use to detect BROM DL mode.
-    }
+    # Precompiled packers for the fixed-size fields of the protocol.
+    _pack_u16be = struct.Struct('>H').pack
+    _unpack_u16be = struct.Struct('>H').unpack
+    _unpack_u16be_from = struct.Struct('>H').unpack_from
+    _unpack_u16be_x2 = struct.Struct('>HH').unpack
+    _unpack_u16be_x4 = struct.Struct('>HHHH').unpack
+    _unpack_u8_u16be = struct.Struct('>BH').unpack
+    _pack_u32be = struct.Struct('>I').pack
+    _unpack_u32be = struct.Struct('>I').unpack
+    _unpack_u32be_u16be = struct.Struct('>IH').unpack
+    _pack_u32be_u8 = struct.Struct('>IB').pack
+    _pack_u32be_x2 = struct.Struct('>II').pack
+    _pack_u32be_x3 = struct.Struct('>III').pack
+    _unpack_u16le_from = struct.Struct('<H').unpack_from
+    _pack_u32le_x4 = struct.Struct('<IIII').pack
+    # Response to the command batch sent for each word by cqdma_read32: two
+    # CMD_WRITE32 (header echo, status, payload echo, status) followed by two
+    # CMD_READ32 (header echo, status, word, status).
+    _unpack_cqdma_read_response = struct.Struct('>9sH4sH9sH4sH9sHIH9sHIH').unpack
 
     socs = {
         0x0279: {
@@ -150,10 +181,30 @@ class UsbDl:
         },
     }
 
-    def __init__(self, port, timeout=1, write_timeout=1, debug=False):
+    def __init__(self, port, timeout=1, write_timeout=1, low_latency=True, verify_echo=True, debug=False):
         self.debug = debug
+        self.verify_echo = verify_echo
+        self._pending_echo = 0
+        self._rx_buf = bytearray()
         self.ser = serial.Serial(port, timeout=timeout, write_timeout=write_timeout)
 
+        # Buffered reads need a file descriptor that works with select(),
+        # which pyserial only provides on POSIX systems.
+        self._fd = None
+        if os.name == 'posix':
+            try:
+                self._fd = self.ser.fileno()
+            except (AttributeError, IOError, ValueError):
+                pass
+
+        if low_latency:
+            # Avoid waiting for the USB-serial latency timer (usually 16 ms)
+            # on every small read. Only supported by pyserial on Linux.
+            try:
+                self.ser.set_low_latency_mode(True)
+            except (AttributeError, IOError, NotImplementedError, ValueError) as e:
+                print("Warning: Failed to enable low latency mode: {}".format(e))
+
         hw_code = self.cmd_get_hw_code()
         self.soc = self.socs.get(hw_code)
         if self.soc is None:
@@ -190,36 +241,113 @@ class UsbDl:
         if self.debug:
             print("-> {}".format(binascii.b2a_hex(data)))
         self.ser.write(data)
-        if echo:
-            echo_data = self.ser.read(len(data))
+        if echo and not self.verify_echo:
+            # Don't wait for the echo, it gets read and discarded along with
+            # the next response.
+            self._pending_echo += len(data)
+        elif echo:
+            echo_data = self._read(len(data))
             if self.debug:
                 print("<- {}".format(binascii.b2a_hex(echo_data)))
             if echo_data != data:
                 raise EchoBytesMismatchException
 
+    def _read(self, count):
+        '''Read up to count bytes from the serial port.
+
+        Where the port has a file descriptor, reads as much as is available
+        at once and keeps the excess for the next call, so a burst of
+        responses only costs a few system calls. Otherwise this falls back
+        to serial.Serial.read(). Either way, this returns fewer bytes if the
+        port's timeout expires.
+        '''
+        fd = self._fd
+        if fd is None:
+            return self.ser.read(count)
+
+        timeout = self.ser.timeout
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while len(self._rx_buf) < count:
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+            ready, _, _ = select.select([fd], [], [], remaining)
+            if not ready:
+                break
+            try:
+                chunk = os.read(fd, 65536)
+            except BlockingIOError:
+                continue
+            if not chunk:
+                break
+            self._rx_buf += chunk
+
+        data = bytes(self._rx_buf[:count])
+        del self._rx_buf[:count]
+        return data
+
+    def reset_input_buffer(self):
+        '''Discard all buffered and pending input.'''
+        self._pending_echo = 0
+        self._rx_buf.clear()
+        self.ser.reset_input_buffer()
+
     def _recv_bytes(self, count):
-        data = self.ser.read(count)
+        skip = self._pending_echo
+        self._pending_echo = 0
+        data = self._read(skip + count)
         if self.debug:
             print("<- {}".format(binascii.b2a_hex(data)))
+        data = data[skip:]
         if len(data) != count:
             raise NotEnoughDataException
         return bytes(data)
 
+    def _send_data(self, data, chunk_size=0x1000):
+        '''Send a data blob without echo.
+
+        The checksum of each chunk is calculated after the chunk has been
+        handed to the serial driver, so it overlaps with the transfer.
+
+        Returns the checksum and the time spent sending, in nanoseconds,
+        not counting the checksum calculation.
+        '''
+        assert chunk_size % 2 == 0
+
+        # Slice by bytes, even if data is a view with a larger item size.
+        view = memoryview(data).cast('B')
+        calc_checksum = 0
+        elapsed = 0
+        for offset in range(0, len(view), chunk_size):
+            chunk = view[offset:offset+chunk_size]
+            start_ns = time.perf_counter_ns()
+            self._send_bytes(chunk, echo=False)
+            elapsed += time.perf_counter_ns() - start_ns
+
+            if len(chunk) % 2 != 0:
+                chunk = bytes(chunk) + b'\0'
+            for i in range(0, len(chunk), 2):
+                calc_checksum ^= self._unpack_u16le_from(chunk, i)[0]
+
+        return (calc_checksum, elapsed)
+
     def get_word(self):
         '''Read a big-endian 16-bit integer from the serial port.'''
-        return struct.unpack('>H', self._recv_bytes(2))[0]
+        return self._unpack_u16be(self._recv_bytes(2))[0]
 
     def put_word(self, word):
         '''Write a big-endian 16-bit integer to the serial port.'''
-        self._send_bytes(struct.pack('>H', word))
+        self._send_bytes(self._pack_u16be(word))
 
     def get_dword(self):
         '''Read a big-endian 32-bit integer from the serial port.'''
-        return struct.unpack('>I', self._recv_bytes(4))[0]
+        return self._unpack_u32be(self._recv_bytes(4))[0]
 
     def put_dword(self, dword):
         '''Write a big-endian 32-bit integer to the serial port.'''
-        self._send_bytes(struct.pack('>I', dword))
+        self._send_bytes(self._pack_u32be(dword))
 
     def cmd_C8(self, subcommand):
         subcommands = {
@@ -248,11 +376,8 @@ class UsbDl:
             'CB': 0xCB,
             'CC': 0xCC,
         }
-        self._send_bytes([self.commands['CMD_C8']])
-        self._send_bytes([subcommands[subcommand]])
-        sub_data = struct.unpack('B', self._recv_bytes(1))[0]
-
-        status = self.get_word()
+        self._send_bytes(CMD_C8 + bytes([subcommands[subcommand]]))
+        sub_data, status = self._unpack_u8_u16be(self._recv_bytes(3))
         if status != 0:
             raise ProtocolError(status)
 
@@ -264,24 +389,30 @@ class UsbDl:
         addr: The 32-bit starting address as an int.
         word_count: The number of words to read as an int.
         '''
-        words = []
+        return list(struct.unpack('>{}I'.format(word_count), self.cmd_read32_bytes(addr, word_count)))
+
+    def cmd_read32_bytes(self, addr, word_count):
+        '''Read 32-bit words starting at an address, without decoding them.
 
-        self._send_bytes([self.commands['CMD_READ32']])
-        self.put_dword(addr)
-        self.put_dword(word_count)
+        Returns a bytes-like object with the words in big-endian byte order,
+        as they were sent by the BROM.
+
+        addr: The 32-bit starting address as an int.
+        word_count: The number of words to read as an int.
+        '''
+        self._send_bytes(CMD_READ32 + self._pack_u32be_x2(addr, word_count))
 
         status = self.get_word()
         if status != 0:
             raise ProtocolError(status)
 
-        for i in range(word_count):
-            words.append(self.get_dword())
-
-        status = self.get_word()
+        # Read all of the words and the trailing status in one go.
+        data = self._recv_bytes(word_count * 4 + 2)
+        status = self._unpack_u16be_from(data, word_count * 4)[0]
         if status != 0:
             raise ProtocolError(status)
 
-        return words
+        return memoryview(data)[:-2]
 
     def cmd_write32(self, addr, words):
         '''Write 32 bit words starting at an address.
@@ -289,74 +420,91 @@ class UsbDl:
         addr: A 32-bit address as an int.
         words: A list of 32-bit ints to write starting at address addr.
         '''
-        self._send_bytes([self.commands['CMD_WRITE32']])
-        self.put_dword(addr)
-        self.put_dword(len(words))
+        self._send_bytes(CMD_WRITE32 + self._pack_u32be_x2(addr, len(words)))
 
         status = self.get_word()
         if status > 0xff:
             raise ProtocolError(status)
 
-        for word in words:
-            self.put_dword(word)
+        # Send the whole payload at once, the BROM echoes it back as a
+        # single block.
+        self._send_bytes(struct.pack('>{}I'.format(len(words)), *words))
 
         status = self.get_word()
         if status > 0xff:
             raise ProtocolError(status)
 
+    def write32_fast(self, addr, words):
+        '''Write 32 bit words starting at an address with a single round-trip.
+
+        Unlike cmd_write32, the payload is sent without waiting for the BROM
+        to accept the address first, so only use this for addresses that are
+        known to be writable. Otherwise the BROM will interpret the payload
+        as commands.
+
+        addr: A 32-bit address as an int.
+        words: A list of 32-bit ints to write starting at address addr.
+        '''
+        header = CMD_WRITE32 + self._pack_u32be_x2(addr, len(words))
+        payload = struct.pack('>{}I'.format(len(words)), *words)
+        self._send_bytes(header + payload, echo=False)
+
+        # Header echo and status, then payload echo and status.
+        data = self._recv_bytes(len(header) + 2)
+        if self.verify_echo and data[:-2] != header:
+            raise EchoBytesMismatchException
+
+        status = self._unpack_u16be(data[-2:])[0]
+        if status > 0xff:
+            raise ProtocolError(status)
+
+        data = self._recv_bytes(len(payload) + 2)
+        if self.verify_echo and data[:-2] != payload:
+            raise EchoBytesMismatchException
+
+        status = self._unpack_u16be(data[-2:])[0]
+        if status > 0xff:
+            raise ProtocolError(status)
+
     def cmd_jump_da(self, addr):
-        self._send_bytes([self.commands['CMD_JUMP_DA']])
-        self.put_dword(addr)
+        self._send_bytes(CMD_JUMP_DA + self._pack_u32be(addr))
 
         status = self.get_word()
         if status > 0xff:
             raise ProtocolError(status)
 
     def cmd_jump_bl(self):
-        self._send_bytes([self.commands['CMD_JUMP_BL']])
+        self._send_bytes(CMD_JUMP_BL)
 
         status = self.get_word()
         if status > 0xff:
             raise ProtocolError(status)
 
     def cmd_send_da(self, load_addr, data, sig_length=0, print_speed=False):
-        self._send_bytes([self.commands['CMD_SEND_DA']])
-        self.put_dword(load_addr)
-        self.put_dword(len(data))
-        self.put_dword(sig_length)
+        self._send_bytes(CMD_SEND_DA + self._pack_u32be_x3(load_addr, len(data), sig_length))
 
         status = self.get_word()
         if status > 0xff:
             raise ProtocolError(status)
 
-        calc_checksum = 0
-        padded_data = data
-        if len(padded_data) % 2 != 0:
-            padded_data += b'\0'
-        for i in range(0, len(padded_data), 2):
-            calc_checksum ^= struct.unpack_from('<H', padded_data, i)[0]
-
-        start_ns = time.perf_counter_ns()
-        self._send_bytes(data, echo=False)
-        end_ns = time.perf_counter_ns()
+        calc_checksum, elapsed = self._send_data(data)
 
-        if print_speed:
-            elapsed = end_ns - start_ns
+        # Nothing is timed for an empty payload.
+        if print_speed and len(data) > 0:
             print("Sent {} DA bytes in {:.6f} seconds ({} bytes per second).".format(len(data), elapsed/1000000000, len(data)*1000000000//elapsed))
 
-        remote_checksum = self.get_word()
+        remote_checksum, status = self._unpack_u16be_x2(self._recv_bytes(4))
 
         if remote_checksum != calc_checksum:
             raise ChecksumError("Checksum mismatch: Expected 0x{:04x}, got 0x{:04x}.".format(calc_checksum, remote_checksum))
 
-        status = self.get_word()
         if status > 0xff:
             raise ProtocolError(status)
 
     def cmd_get_target_config(self):
-        self._send_bytes([self.commands['CMD_GET_TARGET_CONFIG']])
+        self._send_bytes(CMD_GET_TARGET_CONFIG)
 
-        target_config = self.get_dword()
+        target_config, status = self._unpack_u32be_u16be(self._recv_bytes(6))
         print("Target config: 0x{:08X}".format(target_config))
         print("\tSBC enabled: {}".format(True if (target_config & 0x1) else False))
         print("\tSLA enabled: {}".format(True if (target_config & 0x2) else False))
@@ -367,179 +515,150 @@ class UsbDl:
         print("\tMemory write command requires permissions: {}".format(True if (target_config & 0x40) else False))
         print("\tCMD_C8 disabled: {}".format(True if (target_config & 0x80) else False))
 
-        status = self.get_word()
         if status > 0xff:
             raise ProtocolError(status)
 
         return target_config
 
     def cmd_uart1_log_enable(self):
-        self._send_bytes([self.commands['CMD_UART1_LOG_EN']])
+        self._send_bytes(CMD_UART1_LOG_EN)
 
         status = self.get_word()
         if status != 0:
             raise ProtocolError(status)
 
     def cmd_uart1_set_baud(self, baud):
-        self._send_bytes([self.commands['CMD_UART1_SET_BAUD']])
-        self.put_dword(baud)
+        self._send_bytes(CMD_UART1_SET_BAUD + self._pack_u32be(baud))
 
         status = self.get_word()
         if status != 0:
             raise ProtocolError(status)
 
     def cmd_get_brom_log(self):
-        self._send_bytes([self.commands['CMD_GET_BROM_LOG']])
+        self._send_bytes(CMD_GET_BROM_LOG)
         length = self.get_dword()
         log_bytes = self._recv_bytes(length)
 
         return log_bytes
 
     def cmd_jump_da_64(self, addr):
-        self._send_bytes([self.commands['CMD_JUMP_DA_64']])
-        self.put_dword(addr)
-
-        self._send_bytes([0x01])  # Must be 1. If it's 0, boot_aarch64_magic
-                                  # must not be sent, and the BROM will jump to
-                                  # the DA in 32-bit mode.
+        # The last byte must be 1. If it's 0, boot_aarch64_magic must not be
+        # sent, and the BROM will jump to the DA in 32-bit mode.
+        self._send_bytes(CMD_JUMP_DA_64 + self._pack_u32be_u8(addr, 0x01))
 
         status = self.get_word()
         if status != 0:
             raise ProtocolError(status)
 
-        self._send_bytes([0x64])  # boot_aarch64_magic
+        self._send_bytes(b'\x64')  # boot_aarch64_magic
 
         status = self.get_word()
         if status > 0xff:
             raise ProtocolError(status)
 
     def cmd_get_brom_log_new(self):
-        self._send_bytes([self.commands['CMD_GET_BROM_LOG_NEW']])
+        self._send_bytes(CMD_GET_BROM_LOG_NEW)
         length = self.get_dword()
-        log_bytes = self._recv_bytes(length)
+        data = self._recv_bytes(length + 2)
+        log_bytes = data[:-2]
 
-        status = self.get_word()
+        status = self._unpack_u16be(data[-2:])[0]
         if status > 0xff:
             raise ProtocolError(status)
 
         return log_bytes
 
     def scmd_send_cert(self, cert, print_speed=False):
-        self._send_bytes([self.commands['SCMD_SEND_CERT']])
-        self.put_dword(len(cert))
+        self._send_bytes(SCMD_SEND_CERT + self._pack_u32be(len(cert)))
 
         status = self.get_word()
         if status > 0xff:
             raise ProtocolError(status)
 
-        calc_checksum = 0
-        padded_cert = cert
-        if len(padded_cert) % 2 != 0:
-            padded_cert += b'\0'
-        for i in range(0, len(padded_cert), 2):
-            calc_checksum ^= struct.unpack_from('<H', padded_cert, i)[0]
-
-        start_ns = time.perf_counter_ns()
-        self._send_bytes(cert, echo=False)
-        end_ns = time.perf_counter_ns()
+        calc_checksum, elapsed = self._send_data(cert)
 
-        if print_speed:
-            elapsed = end_ns - start_ns
+        # Nothing is timed for an empty payload.
+        if print_speed and len(cert) > 0:
             print("Sent {} certificate bytes in {:.6f} seconds ({} bytes per second).".format(len(cert), elapsed/1000000000, len(cert)*1000000000//elapsed))
 
-        remote_checksum = self.get_word()
+        remote_checksum, status = self._unpack_u16be_x2(self._recv_bytes(4))
 
         if remote_checksum != calc_checksum:
             raise ChecksumError("Checksum mismatch: Expected 0x{:04x}, got 0x{:04x}.".format(calc_checksum, remote_checksum))
 
-        status = self.get_word()
         if status > 0xff:
             raise ProtocolError(status)
 
     def scmd_get_me_id(self):
-        self._send_bytes([self.commands['SCMD_GET_ME_ID']])
+        self._send_bytes(SCMD_GET_ME_ID)
         length = self.get_dword()
-        me_id = self._recv_bytes(length)
+        data = self._recv_bytes(length + 2)
+        me_id = data[:-2]
 
-        status = self.get_word()
+        status = self._unpack_u16be(data[-2:])[0]
         if status != 0:
             raise ProtocolError(status)
 
         return me_id
 
     def scmd_send_auth(self, auth, print_speed=False):
-        self._send_bytes([self.commands['SCMD_SEND_AUTH']])
-        self.put_dword(len(auth))
+        self._send_bytes(SCMD_SEND_AUTH + self._pack_u32be(len(auth)))
 
         status = self.get_word()
         if status > 0xff:
             raise ProtocolError(status)
 
-        calc_checksum = 0
-        padded_auth = auth
-        if len(padded_auth) % 2 != 0:
-            padded_auth += b'\0'
-        for i in range(0, len(padded_auth), 2):
-            calc_checksum ^= struct.unpack_from('<H', padded_auth, i)[0]
-
-        start_ns = time.perf_counter_ns()
-        self._send_bytes(auth, echo=False)
-        end_ns = time.perf_counter_ns()
+        calc_checksum, elapsed = self._send_data(auth)
 
-        if print_speed:
-            elapsed = end_ns - start_ns
+        # Nothing is timed for an empty payload.
+        if print_speed and len(auth) > 0:
             print("Sent {} TOOL_AUTH bytes in {:.6f} seconds ({} bytes per second).".format(len(auth), elapsed/1000000000, len(auth)*1000000000//elapsed))
 
-        remote_checksum = self.get_word()
+        remote_checksum, status = self._unpack_u16be_x2(self._recv_bytes(4))
 
         if remote_checksum != calc_checksum:
             raise ChecksumError("Checksum mismatch: Expected 0x{:04x}, got 0x{:04x}.".format(calc_checksum, remote_checksum))
 
-        status = self.get_word()
         if status > 0xff:
             raise ProtocolError(status)
 
     def scmd_get_soc_id(self):
-        self._send_bytes([self.commands['SCMD_GET_SOC_ID']])
+        self._send_bytes(SCMD_GET_SOC_ID)
         length = self.get_dword()
-        soc_id = self._recv_bytes(length)
+        data = self._recv_bytes(length + 2)
+        soc_id = data[:-2]
 
-        status = self.get_word()
+        status = self._unpack_u16be(data[-2:])[0]
         if status != 0:
             raise ProtocolError(status)
 
         return soc_id
 
     def cmd_get_hw_sw_ver(self):
-        self._send_bytes([self.commands['CMD_GET_HW_SW_VER']])
-        hw_subcode = self.get_word()
-        hw_ver = self.get_word()
-        sw_ver = self.get_word()
-
-        status = self.get_word()
+        self._send_bytes(CMD_GET_HW_SW_VER)
+        hw_subcode, hw_ver, sw_ver, status = self._unpack_u16be_x4(self._recv_bytes(8))
         if status != 0:
             raise ProtocolError(status)
 
         return (hw_subcode, hw_ver, sw_ver)
 
     def cmd_get_hw_code(self):
-        self._send_bytes([self.commands['CMD_GET_HW_CODE']])
-        hw_code = self.get_word()
-
-        status = self.get_word()
+        self._send_bytes(CMD_GET_HW_CODE)
+        hw_code, status = self._unpack_u16be_x2(self._recv_bytes(4))
         if status != 0:
             raise ProtocolError(status)
 
         return hw_code
 
     def check_is_brom(self):
+        # The echo is always checked here, regardless of verify_echo, since a
+        # mismatch is how we detect that we're not talking to the BROM.
+        self._send_bytes(CMD_GET_BL_VER, echo=False)
         try:
-            self._send_bytes([self.commands['CMD_GET_BL_VER']])
-        except EchoBytesMismatchException:
+            return self._recv_bytes(len(CMD_GET_BL_VER)) == CMD_GET_BL_VER
+        except NotEnoughDataException:
             return False
 
-        return True
-
     def memory_range_test(self, addr, byte_count, byte_granularity=4, print_speed=False):
         '''Test a range of memory to see where we have contiguous read access.
 
@@ -564,7 +683,7 @@ class UsbDl:
             if reset_base:
                 base_addr = current_addr
             try:
-                self.cmd_read32(current_addr, byte_granularity // 4)
+                self.cmd_read32_bytes(current_addr, byte_granularity // 4)
                 if not ranges.get(base_addr):
                     ranges[base_addr] = 0
                 ranges[base_addr] += byte_granularity
@@ -594,23 +713,88 @@ class UsbDl:
 
         tmp_addr = self.soc['tmp_addr']
         cqdma_base = self.soc['cqdma_base']
-
-        words = []
+        start_reg = cqdma_base + 0x08
+        src_reg = cqdma_base + 0x1C
+        dst_reg = cqdma_base + 0x20
+        write32 = self.cmd_write32
+        read32 = self.cmd_read32
+        pack_u32be = self._pack_u32be
+        pack_u32be_x2 = self._pack_u32be_x2
+        unpack_response = self._unpack_cqdma_read_response
+
+        # Set DMA destination address and transfer length in bytes. These
+        # are the same for every word.
+        write32(dst_reg, [tmp_addr, 4])
+
+        # The commands for each word are sent as one batch: set the DMA
+        # source address, start the DMA transfer, check that it has finished
+        # and read the word from tmp_addr. The batch for the next word is
+        # sent before the response to the current one is read, so the BROM
+        # always has work queued. Since the BROM runs the commands in order,
+        # tmp_addr is read before the next transfer overwrites it.
+        suffix = (CMD_WRITE32 + pack_u32be_x2(start_reg, 1) + pack_u32be(0x00000001) +
+                  CMD_READ32 + pack_u32be_x2(start_reg, 1) +
+                  CMD_READ32 + pack_u32be_x2(tmp_addr, 1))
+        prefix = CMD_WRITE32 + pack_u32be_x2(src_reg, 1)
+
+        words = [0] * word_count
+        retry = []
+        previous_busy = False
+        next_batch = prefix + pack_u32be(addr) + suffix
+        if word_count > 0:
+            self._send_bytes(next_batch, echo=False)
         for i in range(word_count):
+            batch = next_batch
+            in_flight = i + 1 < word_count
+            if in_flight:
+                next_batch = prefix + pack_u32be(addr+(i+1)*4) + suffix
+                self._send_bytes(next_batch, echo=False)
+
+            try:
+                (e0, s0, e1, s1, e2, s2, e3, s3, e4, s4, dma_status, s5, e5, s6, word, s7) = unpack_response(self._recv_bytes(68))
+                if self.verify_echo and e0 + e1 + e2 + e3 + e4 + e5 != batch:
+                    raise EchoBytesMismatchException
+                for status in (s0, s1, s2, s3):
+                    if status > 0xff:
+                        raise ProtocolError(status)
+                for status in (s4, s5, s6, s7):
+                    if status != 0:
+                        raise ProtocolError(status)
+            except (EchoBytesMismatchException, ProtocolError):
+                if in_flight:
+                    # The batch for the next word has already been sent, so
+                    # drop its response to keep the next command in sync.
+                    try:
+                        self._recv_bytes(68)
+                    except NotEnoughDataException:
+                        pass
+                raise
+
+            # If the previous transfer hadn't finished yet, this word's
+            # batch was sent while it was still running, so its START may
+            # have been ignored and tmp_addr may hold the previous word.
+            if dma_status & 1 or previous_busy:
+                # Read this word again later.
+                retry.append(i)
+            else:
+                words[i] = word
+            previous_busy = bool(dma_status & 1)
+
+        for i in retry:
+            # Wait for any previous transaction to finish.
+            while True:
+                if (read32(start_reg, 1)[0] & 1) == 0:
+                    break
             # Set DMA source address.
-            self.cmd_write32(cqdma_base+0x1C, [addr+i*4])
-            # Set DMA destination address.
-            self.cmd_write32(cqdma_base+0x20, [tmp_addr])
-            # Set DMA transfer length in bytes.
-            self.cmd_write32(cqdma_base+0x24, [4])
+            write32(src_reg, [addr+i*4])
             # Start DMA transfer.
-            self.cmd_write32(cqdma_base+0x08, [0x00000001])
+            write32(start_reg, [0x00000001])
             # Wait for transaction to finish.
             while True:
-                if (self.cmd_read32(cqdma_base+0x08, 1)[0] & 1) == 0:
+                if (read32(start_reg, 1)[0] & 1) == 0:
                     break
             # Read word from tmp_addr.
-            words.extend(self.cmd_read32(tmp_addr, 1))
+            words[i] = read32(tmp_addr, 1)[0]
 
         return words
 
@@ -623,24 +807,25 @@ class UsbDl:
 
         tmp_addr = self.soc['tmp_addr']
         cqdma_base = self.soc['cqdma_base']
+        start_reg = cqdma_base + 0x08
+        src_reg = cqdma_base + 0x1C
+        write32 = self.cmd_write32
+        read32 = self.cmd_read32
 
-        for i in range(len(words)):
+        for i, word in enumerate(words):
             # Write word to tmp_addr.
-            self.cmd_write32(tmp_addr, [words[i]])
-            # Set DMA source address.
-            self.cmd_write32(cqdma_base+0x1C, [tmp_addr])
-            # Set DMA destination address.
-            self.cmd_write32(cqdma_base+0x20, [addr+i*4])
-            # Set DMA transfer length in bytes.
-            self.cmd_write32(cqdma_base+0x24, [4])
+            write32(tmp_addr, [word])
+            # Set DMA source address, destination address and transfer
+            # length in bytes.
+            write32(src_reg, [tmp_addr, addr+i*4, 4])
             # Start DMA transfer.
-            self.cmd_write32(cqdma_base+0x08, [0x00000001])
+            write32(start_reg, [0x00000001])
             # Wait for transaction to finish.
             while True:
-                if (self.cmd_read32(cqdma_base+0x08, 1)[0] & 1) == 0:
+                if (read32(start_reg, 1)[0] & 1) == 0:
                     break
             # Write dummy word to tmp_addr for error detection.
-            self.cmd_write32(tmp_addr, [0xc0ffeeee])
+            write32(tmp_addr, [0xc0ffeeee])
 
     def memory_read(self, addr, count, cqdma=False, print_speed=False):
         '''Read a range of memory to a byte array.
@@ -652,18 +837,21 @@ class UsbDl:
         if (count % 4) > 0:
             word_count += 1
 
-        words = []
         start_ns = time.perf_counter_ns()
         if cqdma:
             words = self.cqdma_read32(addr, word_count)
         else:
-            words = self.cmd_read32(addr, word_count)
+            raw = self.cmd_read32_bytes(addr, word_count)
         end_ns = time.perf_counter_ns()
 
-        data = b''
-        for word in words:
-            data += struct.pack('<I', word)
-        data = data[:count]
+        if cqdma:
+            data = struct.pack('<{}I'.format(len(words)), *words)[:count]
+        else:
+            # Convert the big-endian words to little-endian in one pass.
+            swapped = array.array(U32_TYPECODE)
+            swapped.frombytes(raw)
+            swapped.byteswap()
+            data = swapped.tobytes()[:count]
 
         if print_speed:
             elapsed = end_ns - start_ns
@@ -685,9 +873,7 @@ class UsbDl:
         if remaining_bytes > 0:
             padded_data += b'\0' * (4 - remaining_bytes)
 
-        words = []
-        for i in range(0, len(padded_data), 4):
-            words.append(struct.unpack_from('<I', padded_data, i)[0])
+        words = list(struct.unpack('<{}I'.format(len(padded_data)//4), padded_data))
 
         start_ns = time.perf_counter_ns()
         if cqdma:
@@ -700,6 +886,36 @@ class UsbDl:
             elapsed = end_ns - start_ns
             print("Wrote {} bytes in {:.6f} seconds ({} bytes per second).".format(len(data), elapsed/1000000000, len(data)*1000000000//elapsed))
 
+    def memory_read_uart(self, addr, count, uart, stub, stub_addr=0x00100A00, uart_base=0x11002000, cqdma=False, print_speed=False):
+        '''Read a range of memory by running a stub that sends it over a UART.
+
+        The stub (demo/uart-dump) is loaded to stub_addr and started with
+        CMD_JUMP_DA, so the DA must already be marked as verified. The whole
+        range is then sent in one go instead of one command per word.
+
+        addr: A 32-bit address as an int.
+        count: The length of data to read, in bytes.
+        uart: A serial port connected to the UART at uart_base. Its timeout
+              must be long enough to receive count bytes.
+        stub: The uart-dump stub binary.
+        '''
+        self.memory_write(stub_addr, stub + self._pack_u32le_x4(0, uart_base, addr, count), cqdma=cqdma)
+
+        uart.reset_input_buffer()
+        start_ns = time.perf_counter_ns()
+        self.cmd_jump_da(stub_addr)
+        data = uart.read(count)
+        end_ns = time.perf_counter_ns()
+
+        if len(data) != count:
+            raise NotEnoughDataException
+
+        if print_speed:
+            elapsed = end_ns - start_ns
+            print("Read {} bytes in {:.6f} seconds ({} bytes per second).".format(len(data), elapsed/1000000000, len(data)*1000000000//elapsed))
+
+        return data
+
     def wdt_reset(self):
         self.cmd_write32(self.soc['toprgu'][0], [0x22000000 | 0x10 | 0x4])
         time.sleep(0.001)
@@ -709,10 +925,12 @@ class UsbDl:
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('port', type=str, help="The serial port you want to connect to.")
+    parser.add_argument('--uart', type=str, help="The serial port connected to UART0. If given, the BROM is dumped over UART0 by a stub.")
+    parser.add_argument('--no-verify-echo', action='store_true', help="Don't wait for and check echoed bytes. Faster, but errors are detected later.")
     args = parser.parse_args()
 
     try:
-        usbdl = UsbDl(args.port, debug=False)
+        usbdl = UsbDl(args.port, verify_echo=not args.no_verify_echo, debug=False)
     except DeviceResetException as e:
         print(e)
         sys.exit(0)
@@ -733,12 +951,13 @@ if __name__ == "__main__":
 
     # Print a string to UART0.
     for byte in "Hello, there!\r\n".encode('utf-8'):
-        usbdl.cmd_write32(0x11002000, [byte])
+        usbdl.write32_fast(0x11002000, [byte])
 
     try:
         # The C8 B1 command disables caches.
         usbdl.cmd_C8('B1')
-    except:
+    except (EchoBytesMismatchException, NotEnoughDataException, ProtocolError):
+        # CMD_C8 can be disabled by the target config.
         pass
 
     # Assume we have to use the CQDMA to access restricted memory.
@@ -754,16 +973,53 @@ if __name__ == "__main__":
         use_cqdma = False
 
     # NOTE: Using the CQDMA method to dump a large (>4kB) chunk of memory,
-    # like the entire BROM, will almost certainly fail and cause the CPU to
-    # reset. To work around this, try dumping the memory in smaller chunks,
-    # like 1kB, and saving them to disk, then reboot the SoC into BROM mode
-    # again and dump the next chunk until you've dumped the memory you're
-    # interested in.
+    # like the entire BROM, in one go will almost certainly fail and cause
+    # the CPU to reset. To work around this, dump the memory in smaller
+    # chunks, and use even smaller chunks if reading one fails.
 
     # Dump BROM.
     print("Dumping BROM...")
-    brom = usbdl.memory_read(usbdl.soc['brom'][0], usbdl.soc['brom'][1], cqdma=use_cqdma, print_speed=True)
-    if len(brom) != usbdl.soc['brom'][1]:
+    brom_addr, brom_size = usbdl.soc['brom']
+    if args.uart:
+        if not usbdl.soc.get('brom_g_da_verified', False):
+            print("Error: No DA verification address specified, exiting...")
+            sys.exit(1)
+
+        # Mark DA as verified, so we can run the stub.
+        if use_cqdma:
+            usbdl.cqdma_write32(usbdl.soc['brom_g_da_verified'], [1])
+        else:
+            usbdl.cmd_write32(usbdl.soc['brom_g_da_verified'], [1])
+
+        stub = open("demo/uart-dump/uart-dump.bin", 'rb').read()
+        uart = serial.Serial(args.uart, 115200, timeout=brom_size*10//115200 + 1)
+        brom = usbdl.memory_read_uart(brom_addr, brom_size, uart, stub, cqdma=use_cqdma, print_speed=True)
+        uart.close()
+    else:
+        chunk_size = 1024
+        chunks = []
+        offset = 0
+        start_ns = time.perf_counter_ns()
+        while offset < brom_size:
+            try:
+                chunk = usbdl.memory_read(brom_addr + offset, min(chunk_size, brom_size - offset), cqdma=use_cqdma)
+            except (EchoBytesMismatchException, NotEnoughDataException, ProtocolError) as e:
+                if chunk_size <= 4:
+                    raise
+                chunk_size //= 2
+                # Drop whatever is left of the failed response.
+                time.sleep(0.1)
+                usbdl.reset_input_buffer()
+                print("Reading 0x{:08X} failed ({}), retrying with {} byte chunks...".format(brom_addr + offset, type(e).__name__, chunk_size))
+                continue
+            chunks.append(chunk)
+            offset += len(chunk)
+        end_ns = time.perf_counter_ns()
+        brom = b''.join(chunks)
+        elapsed = end_ns - start_ns
+        print("Read {} bytes in {:.6f} seconds ({} bytes per second).".format(len(brom), elapsed/1000000000, len(brom)*1000000000//elapsed))
+
+    if len(brom) != brom_size:
         print("Error: Failed to dump entire BROM.")
         sys.exit(1)
 